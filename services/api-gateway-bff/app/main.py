@@ -11,15 +11,18 @@
 # This service proxies and aggregates; it owns NO data itself.
 # Kong Gateway is the L4 ingress; the BFF is L7 business logic aggregation.
 
+import asyncio
 import os
 import time
 from typing import Optional
 
 import httpx
+import orjson
 from fastapi import FastAPI, HTTPException, Request, Response
-from fastapi.responses import JSONResponse
-from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from fastapi.responses import JSONResponse, StreamingResponse
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 from pydantic_settings import BaseSettings
+from starlette.background import BackgroundTask
 
 
 class Settings(BaseSettings):
@@ -28,6 +31,11 @@ class Settings(BaseSettings):
     PRODUCT_SERVICE_URL: str = "http://product-service:8000"
     ORDER_SERVICE_URL: str   = "http://order-service:8080"
     PAYMENT_SERVICE_URL: str = "http://payment-service:8090"
+    # Per-section time budgets (seconds) for the /api/dashboard fan-out.
+    # The slowest budget bounds the whole dashboard response.
+    DASHBOARD_USER_TIMEOUT: float     = 0.3
+    DASHBOARD_ORDERS_TIMEOUT: float   = 0.5
+    DASHBOARD_PRODUCTS_TIMEOUT: float = 0.3
     # Kubernetes DNS format: http://<service-name>.<namespace>.svc.cluster.local:<port>
     # Short form works within the same namespace.
 
@@ -46,19 +54,60 @@ app = FastAPI(
 # ── Prometheus ────────────────────────────────────────────────
 REQUEST_COUNT   = Counter('bff_http_requests_total', 'BFF total requests', ['method', 'path', 'status'])
 REQUEST_LATENCY = Histogram('bff_request_latency_seconds', 'BFF request latency', ['path'])
+DASHBOARD_PARTIAL = Counter('bff_dashboard_partial_total', 'Dashboard sections dropped (timeout or upstream error)', ['section'])
+UPSTREAM_INFLIGHT = Gauge('bff_upstream_inflight', 'Proxied requests currently in flight per upstream', ['upstream'])
+
+# Bound label children, memoised on first use — a dict lookup instead of
+# .labels() (stringify + validate + lock) on every request
+_count_children: dict = {}
+_latency_children: dict = {}
 
 @app.middleware("http")
 async def metrics_middleware(request: Request, call_next):
-    start = time.time()
+    start = time.perf_counter()
     response = await call_next(request)
-    REQUEST_COUNT.labels(request.method, request.url.path, response.status_code).inc()
-    REQUEST_LATENCY.labels(request.url.path).observe(time.time() - start)
+    # Route template (/api/products/{path:path}) keeps label cardinality bounded
+    route = request.scope.get("route")
+    path = route.path if route else "unmatched"
+
+    key = (request.method, path, response.status_code)
+    counter = _count_children.get(key)
+    if counter is None:
+        counter = _count_children[key] = REQUEST_COUNT.labels(*key)
+    counter.inc()
+
+    latency = _latency_children.get(path)
+    if latency is None:
+        latency = _latency_children[path] = REQUEST_LATENCY.labels(path)
+    latency.observe(time.perf_counter() - start)
     return response
 
 # ── Shared HTTP client ────────────────────────────────────────
 # One client shared across all requests with connection pooling.
-# timeout=10 means we fail fast if an upstream is slow.
-http_client = httpx.AsyncClient(timeout=10.0)
+# Explicit pool limits keep warm keep-alive connections to each upstream
+# instead of paying a TCP handshake per request; http2=True lets concurrent
+# calls to the same upstream multiplex over one connection where supported.
+#
+# Timeouts are split by phase:
+#   connect=1  — an unreachable upstream fails fast
+#   read/write=10 — a slow upstream still gets time to answer
+#   pool=2     — a saturated pool fails fast (503) instead of queueing
+#                requests indefinitely and cascading the slowdown
+# retries=1 retries a failed *connect* once (never a sent request).
+# NOTE: when a transport is passed, limits/http2 must be set on the
+# transport — httpx ignores the client-level arguments.
+http_client = httpx.AsyncClient(
+    timeout=httpx.Timeout(connect=1.0, read=10.0, write=10.0, pool=2.0),
+    transport=httpx.AsyncHTTPTransport(
+        retries=1,
+        http2=True,
+        limits=httpx.Limits(
+            max_keepalive_connections=100,
+            max_connections=200,
+            keepalive_expiry=30.0,
+        ),
+    ),
+)
 
 
 @app.on_event("shutdown")
@@ -96,28 +145,80 @@ async def dashboard(request: Request):
     """
     headers = forward_auth(request)
 
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        # Fan-out: fire all three calls concurrently
-        import asyncio
-        user_task     = client.get(f"{settings.USER_SERVICE_URL}/users/me", headers=headers)
-        orders_task   = client.get(f"{settings.ORDER_SERVICE_URL}/orders",  headers=headers)
-        products_task = client.get(f"{settings.PRODUCT_SERVICE_URL}/products?limit=5")
-
-        user_res, orders_res, products_res = await asyncio.gather(
-            user_task, orders_task, products_task,
-            return_exceptions=True
-        )
-
-    # Gracefully handle individual service failures
-    user     = user_res.json()     if not isinstance(user_res, Exception)     and user_res.status_code == 200     else None
-    orders   = orders_res.json()   if not isinstance(orders_res, Exception)   and orders_res.status_code == 200   else []
-    products = products_res.json() if not isinstance(products_res, Exception) and products_res.status_code == 200 else []
-
-    return {
-        "user": user,
-        "recent_orders": orders[:5],
-        "featured_products": products,
-    }
+    # Fan-out: fire all three calls concurrently over the shared pool.
+    # User-scoped calls are skipped for anonymous requests — upstream would
+    # only answer 401. Tokens are still verified by the upstreams themselves.
+    # Each call gets its own time budget, so one slow upstream costs us that
+    # section rather than pinning the whole response to the client timeout.
+    authed = "Authorization" in headers
+    async with asyncio.TaskGroup() as tg:
+        user_task = tg.create_task(_section(
+            "user",
+            http_client.get(f"{settings.USER_SERVICE_URL}/users/me", headers=headers) if authed else _skipped(),
+            settings.DASHBOARD_USER_TIMEOUT,
+        ))
+        orders_task = tg.create_task(_section(
+            "orders",
+            http_client.get(f"{settings.ORDER_SERVICE_URL}/orders?limit=5", headers=headers) if authed else _skipped(),
+            settings.DASHBOARD_ORDERS_TIMEOUT,
+        ))
+        products_task = tg.create_task(_section(
+            "products",
+            http_client.get(f"{settings.PRODUCT_SERVICE_URL}/products?limit=5"),
+            settings.DASHBOARD_PRODUCTS_TIMEOUT,
+        ))
+
+    # Gracefully handle individual service failures: a failed section
+    # becomes a null / [] JSON literal.
+    # Upstream bodies are already JSON — stitch the bytes together instead
+    # of parsing each one and re-serialising the aggregate
+    body = (
+        b'{"user":' + _ok_bytes(user_task.result())
+        + b',"recent_orders":' + _ok_bytes(orders_task.result(), b"[]")
+        + b',"featured_products":' + _ok_bytes(products_task.result(), b"[]")
+        + b'}'
+    )
+    return Response(content=body, media_type="application/json")
+
+
+def _ok_bytes(res, default: bytes = b"null") -> bytes:
+    """Raw JSON body of a successful section, or `default` for a failed one."""
+    if isinstance(res, httpx.Response) and res.status_code == 200:
+        return res.content
+    return default
+
+
+async def _section(name: str, call, budget: float):
+    """
+    Await one dashboard upstream call within its time budget.
+    Never raises (a TaskGroup would cancel the sibling calls): timeouts,
+    transport errors and anything else (e.g. a malformed *_SERVICE_URL) are
+    returned as the exception. These and non-200 responses count as partial.
+    """
+    try:
+        res = await asyncio.wait_for(call, timeout=budget)
+    except Exception as exc:
+        if not isinstance(exc, (asyncio.TimeoutError, httpx.TransportError)):
+            print(f"[dashboard] {name} call failed: {exc!r}")
+        DASHBOARD_PARTIAL.labels(name).inc()
+        return exc
+
+    # Only failed responses are parsed, and only for the log line.
+    # Skipped calls (anonymous dashboard) are not a degradation and
+    # aren't counted.
+    if isinstance(res, httpx.Response) and res.status_code != 200:
+        DASHBOARD_PARTIAL.labels(name).inc()
+        try:
+            detail = orjson.loads(res.content)
+        except orjson.JSONDecodeError:
+            detail = res.text[:200]
+        print(f"[dashboard] {name} upstream returned {res.status_code}: {detail}")
+    return res
+
+
+async def _skipped() -> None:
+    """Stand-in for an upstream call that was not made; handled like a failure."""
+    return None
 
 
 # ── Proxy Endpoints ───────────────────────────────────────────
@@ -126,11 +227,11 @@ async def dashboard(request: Request):
 
 @app.api_route("/api/users/{path:path}", methods=["GET", "POST", "PUT", "PATCH", "DELETE"])
 async def proxy_users(path: str, request: Request):
-    return await _proxy(request, f"{settings.USER_SERVICE_URL}/users/{path}")
+    return await _proxy(request, "user", f"{settings.USER_SERVICE_URL}/users/{path}")
 
 @app.api_route("/api/products/{path:path}", methods=["GET", "POST", "PUT", "PATCH", "DELETE"])
 async def proxy_products(path: str, request: Request):
-    return await _proxy(request, f"{settings.PRODUCT_SERVICE_URL}/products/{path}")
+    return await _proxy(request, "product", f"{settings.PRODUCT_SERVICE_URL}/products/{path}")
 
 @app.api_route("/api/products", methods=["GET", "POST"])
 async def proxy_products_root(request: Request):
@@ -138,48 +239,129 @@ async def proxy_products_root(request: Request):
     url = f"{settings.PRODUCT_SERVICE_URL}/products"
     if qs:
         url += f"?{qs}"
-    return await _proxy(request, url)
+    return await _proxy(request, "product", url)
 
 @app.api_route("/api/orders/{path:path}", methods=["GET", "POST", "PUT", "PATCH", "DELETE"])
 async def proxy_orders(path: str, request: Request):
-    return await _proxy(request, f"{settings.ORDER_SERVICE_URL}/orders/{path}")
+    return await _proxy(request, "order", f"{settings.ORDER_SERVICE_URL}/orders/{path}")
 
 @app.api_route("/api/orders", methods=["GET", "POST"])
 async def proxy_orders_root(request: Request):
-    return await _proxy(request, f"{settings.ORDER_SERVICE_URL}/orders")
+    return await _proxy(request, "order", f"{settings.ORDER_SERVICE_URL}/orders")
 
 @app.api_route("/api/payments/{path:path}", methods=["GET", "POST"])
 async def proxy_payments(path: str, request: Request):
-    return await _proxy(request, f"{settings.PAYMENT_SERVICE_URL}/payments/{path}")
+    return await _proxy(request, "payment", f"{settings.PAYMENT_SERVICE_URL}/payments/{path}")
 
 @app.api_route("/api/payments", methods=["GET", "POST"])
 async def proxy_payments_root(request: Request):
-    return await _proxy(request, f"{settings.PAYMENT_SERVICE_URL}/payments")
+    return await _proxy(request, "payment", f"{settings.PAYMENT_SERVICE_URL}/payments")
 
 @app.api_route("/api/auth/{path:path}", methods=["POST"])
 async def proxy_auth(path: str, request: Request):
-    return await _proxy(request, f"{settings.USER_SERVICE_URL}/auth/{path}")
+    return await _proxy(request, "user", f"{settings.USER_SERVICE_URL}/auth/{path}")
 
 
-async def _proxy(request: Request, target_url: str) -> Response:
-    """Generic reverse proxy — forwards method, headers, and body."""
-    headers = dict(request.headers)
-    headers.pop("host", None)  # Remove original Host header
-    body = await request.body()
+# Hop-by-hop headers (RFC 7230 §6.1) plus Host — these describe the
+# client→BFF connection and must not be forwarded upstream.
+# Content-Length is end-to-end and is kept: with it set, httpx streams the
+# body as-is instead of re-chunking it.
+_HOP = frozenset(
+    b"host connection keep-alive proxy-authenticate proxy-authorization "
+    b"te trailers transfer-encoding upgrade".split()
+)
+
+
+# Per-upstream concurrency limits. Together they stay under the shared
+# pool's max_connections (200), so one degraded upstream can fill only its
+# own slots: further requests to it are shed with a 503 after a short wait
+# instead of queueing on the pool and starving the healthy upstreams.
+_SEMS = {
+    "user":    asyncio.Semaphore(50),
+    "product": asyncio.Semaphore(50),
+    "order":   asyncio.Semaphore(50),
+    "payment": asyncio.Semaphore(20),
+}
+_SEM_WAIT = 0.1  # seconds to wait for a slot before shedding
+
+
+async def _proxy(request: Request, upstream_name: str, target_url: str) -> Response:
+    """
+    Generic reverse proxy — forwards method, headers, and body.
+    The upstream response is streamed back chunk by chunk, so memory per
+    in-flight request stays constant regardless of body size.
+    """
+    # Filter the raw ASGI header list directly — no dict copy, no
+    # case-insensitive lookups
+    headers = [(k, v) for k, v in request.headers.raw if k.lower() not in _HOP]
+    # Stream the body through instead of buffering it; bodiless requests
+    # (most GETs) send no content at all
+    has_body = "content-length" in request.headers or "transfer-encoding" in request.headers
+    body = request.stream() if has_body else None
+
+    req = http_client.build_request(
+        method=request.method,
+        url=target_url,
+        headers=headers,
+        content=body,
+    )
+
+    sem = _SEMS[upstream_name]
+    try:
+        await asyncio.wait_for(sem.acquire(), timeout=_SEM_WAIT)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail="upstream overloaded")
+    inflight = UPSTREAM_INFLIGHT.labels(upstream_name)
+    inflight.inc()
+    released = False
+
+    def release():
+        # Reached from several paths below — must give the slot back once
+        nonlocal released
+        if not released:
+            released = True
+            inflight.dec()
+            sem.release()
 
     try:
-        upstream = await http_client.request(
-            method=request.method,
-            url=target_url,
-            headers=headers,
-            content=body,
-        )
-        return Response(
-            content=upstream.content,
-            status_code=upstream.status_code,
-            headers=dict(upstream.headers),
-        )
-    except httpx.TimeoutException:
-        raise HTTPException(status_code=504, detail="Upstream service timed out")
-    except httpx.ConnectError:
-        raise HTTPException(status_code=502, detail="Could not connect to upstream service")
+        try:
+            upstream = await http_client.send(req, stream=True)
+        except httpx.PoolTimeout:
+            raise HTTPException(status_code=503, detail="Too many in-flight upstream requests")
+        except httpx.TimeoutException:
+            raise HTTPException(status_code=504, detail="Upstream service timed out")
+        except httpx.ConnectError:
+            raise HTTPException(status_code=502, detail="Could not connect to upstream service")
+    except BaseException:
+        release()  # no response to stream — give the slot back now
+        raise
+
+    # aiter_raw passes bytes through undecoded, so the upstream
+    # Content-Encoding/Content-Length headers stay valid as-is.
+    # The connection returns to the pool once the body is fully sent, and
+    # the concurrency slot is held until then too.
+    async def finish():
+        try:
+            await upstream.aclose()
+        finally:
+            release()
+
+    # finish() runs from both places: the background task is skipped when
+    # the body iterator raises (e.g. a ReadError mid-stream), and the
+    # generator's finally may not run when the client disconnects (Starlette
+    # still runs the background task then). Both steps are idempotent.
+    async def body_stream():
+        try:
+            async for chunk in upstream.aiter_raw():
+                yield chunk
+        finally:
+            await finish()
+
+    response = StreamingResponse(
+        body_stream(),
+        status_code=upstream.status_code,
+        background=BackgroundTask(finish),
+    )
+    # raw list (not a dict) so repeated headers like Set-Cookie survive
+    response.raw_headers = [(k, v) for k, v in upstream.headers.raw if k.lower() not in _HOP]
+    return response
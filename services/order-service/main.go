@@ -103,9 +103,16 @@ func jwtMiddleware() gin.HandlerFunc {
 
 func listOrders(c *gin.Context) {
 	userID := c.GetInt("userID")
-	rows, err := db.QueryContext(c.Request.Context(),
-		`SELECT id, user_id, product_id, quantity, total_price, status, created_at, updated_at
-		 FROM orders WHERE user_id = $1 ORDER BY created_at DESC`, userID)
+	query := `SELECT id, user_id, product_id, quantity, total_price, status, created_at, updated_at
+		 FROM orders WHERE user_id = $1 ORDER BY created_at DESC`
+	args := []interface{}{userID}
+	// Optional ?limit=N — lets callers like the BFF dashboard fetch only the
+	// most recent orders instead of slicing the full history client-side
+	if limit, err := strconv.Atoi(c.Query("limit")); err == nil && limit > 0 {
+		query += " LIMIT $2"
+		args = append(args, limit)
+	}
+	rows, err := db.QueryContext(c.Request.Context(), query, args...)
 	if err != nil {
 		c.JSON(http.StatusInternalServerError, gin.H{"error": err.Error()})
 		return
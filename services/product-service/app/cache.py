@@ -0,0 +1,324 @@
+# ============================================
+# app/cache.py — Redis Response Cache
+# ============================================
+# Cache-aside layer for the read-heavy catalogue endpoints.
+# WHY: product browsing is unauthenticated and the data changes rarely,
+# so most GET /products calls can be answered from Redis without a
+# MongoDB round-trip + BSON decode + Pydantic serialisation.
+#
+# Invalidation strategy:
+#   - Single products are keyed by id and deleted on PATCH/DELETE.
+#   - List entries record the version counter (products:ver) they were
+#     built at. Any mutation INCRs the counter, so every older list entry
+#     reads as a miss and is overwritten — no SCAN/KEYS over the keyspace.
+#     The counter is fetched in the same round-trip as the entry.
+#   - A result is only stored if products:ver is unchanged since the
+#     lookup — otherwise it may have been read from MongoDB before a
+#     concurrent write and would re-cache the old document (see store).
+#
+# Entries are Redis hashes: the JSON body under "body" plus any response
+# headers (e.g. X-Next-Cursor) under "h:<name>", so a hit replays the
+# exact response without re-encoding.
+#
+# Stale-while-revalidate: an entry is fresh for `ttl` seconds, then served
+# stale for a further `grace` seconds while ONE background task refreshes
+# it. Readers never wait on MongoDB for a popular key, and if MongoDB is
+# down the stale copy keeps being served until the grace period runs out.
+#
+# Two tiers: a small per-process TTLCache (L1, capped at 16 MiB) sits in
+# front of Redis (L2) so the hottest keys skip even the Redis round-trip.
+# L1 entries live a few seconds; on any write, invalidate() publishes on products:invalidate and
+# every worker in every pod clears its L1 (see listen_for_invalidations).
+#
+# Redis is an optimisation, not a dependency: every Redis error falls
+# through to MongoDB so a cache outage never fails a request.
+
+import asyncio
+import functools
+import hashlib
+import time
+from typing import Awaitable, Callable, Optional
+
+import orjson
+import redis.asyncio as redis
+from cachetools import TTLCache
+from fastapi.responses import Response
+from prometheus_client import Counter
+
+from .database import settings
+
+LIST_TTL    = 30    # seconds — lists go stale quickly as stock changes
+LIST_GRACE  = 120   # seconds a stale list may be served while refreshing
+ITEM_TTL    = 300   # seconds — single products are invalidated explicitly
+ITEM_GRACE  = 300
+REFRESH_LOCK_TTL = 10  # seconds — at most one refresh per key in this window
+# A stalled or unreachable Redis must fail fast so requests fall through
+# to MongoDB instead of hanging — redis-py's default is no timeout at all
+REDIS_TIMEOUT = 0.25        # seconds, for connect and for each command
+HEALTH_CHECK_INTERVAL = 30  # seconds idle before a connection is PINGed on reuse
+VERSION_KEY = "products:ver"
+INVALIDATE_CHANNEL = "products:invalidate"
+
+CACHE_HITS   = Counter('product_service_cache_hits_total',   'Redis cache hits',   ['endpoint'])
+CACHE_MISSES = Counter('product_service_cache_misses_total', 'Redis cache misses', ['endpoint'])
+CACHE_STALE  = Counter('product_service_cache_stale_total',  'Stale cache entries served while refreshing', ['endpoint'])
+L1_HITS      = Counter('product_service_cache_l1_hits_total', 'In-process cache hits', ['endpoint'])
+INVALIDATION_FAILURES = Counter('product_service_cache_invalidation_failures_total',
+                                'Writes whose cache invalidation was lost to a Redis error')
+
+# L1: (endpoint, params) → (body, headers, size). Keyed on the request
+# parameters rather than the Redis key, because building a list key needs a
+# Redis GET. Bounded by bytes, not entries: params are client-controlled and
+# a single 100-item page can be large, so an entry count alone would let one
+# client cycling ?skip= pin hundreds of MB per worker.
+L1_MAX_BYTES = 16 * 1024 * 1024  # per worker
+L1_MAX_ENTRY = 1024 * 1024       # larger responses are served from Redis only
+_l1: TTLCache = TTLCache(maxsize=L1_MAX_BYTES, ttl=5, getsizeof=lambda entry: entry[2])
+# Bumped on every L1 clear — a fill that started before a clear is dropped
+_l1_gen = 0
+
+
+def _clear_l1():
+    global _l1_gen
+    _l1_gen += 1
+    _l1.clear()
+
+
+def _l1_put(local_key: tuple, gen: int, body: bytes, headers: dict):
+    """Admit an entry unless L1 was cleared since `gen` or it is too large."""
+    size = len(body) + len(repr(local_key))  # the key is client-controlled too
+    if gen == _l1_gen and size <= L1_MAX_ENTRY:
+        _l1[local_key] = (body, headers, size)
+
+# Strong references to in-flight background refreshes (the event loop only
+# keeps weak ones, so an unreferenced task can be garbage-collected)
+_background: set = set()
+
+# Global client — redis-py keeps its own connection pool
+redis_client: Optional[redis.Redis] = None
+_listener: Optional[asyncio.Task] = None
+
+
+async def connect_to_redis():
+    """Called at app startup to initialise the Redis client."""
+    global redis_client, _listener
+    redis_client = redis.Redis(
+        host=settings.REDIS_HOST,
+        port=settings.REDIS_PORT,
+        password=settings.REDIS_PASSWORD or None,
+        socket_connect_timeout=REDIS_TIMEOUT,
+        socket_timeout=REDIS_TIMEOUT,
+        health_check_interval=HEALTH_CHECK_INTERVAL,
+    )
+    _listener = asyncio.create_task(listen_for_invalidations())
+    print(f"[cache] Redis client ready: {settings.REDIS_HOST}:{settings.REDIS_PORT}")
+
+
+async def close_redis_connection():
+    """Called at app shutdown to release the connection pool."""
+    global redis_client, _listener
+    # Stop the listener and any in-flight refreshes before the client goes
+    tasks = [*_background, *([_listener] if _listener else [])]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    _listener = None
+    if redis_client:
+        await redis_client.aclose()
+        redis_client = None
+        print("[cache] Redis connection closed")
+
+
+# ── Key builders ──────────────────────────────────────────────
+async def list_key(
+    category: Optional[str], search: Optional[str], skip: int, limit: int, cursor: Optional[str]
+) -> str:
+    """List entries are versioned (see cached(versioned=True)), not their keys."""
+    raw = f"list:{category}:{search}:{skip}:{limit}:{cursor}"
+    return f"products:list:{hashlib.sha256(raw.encode()).hexdigest()}"
+
+
+async def item_key(product_id: str) -> str:
+    return f"products:item:{product_id}"
+
+
+def dumps(obj) -> bytes:
+    """
+    orjson encoder shared by the cache and the list endpoint.
+    orjson handles datetime natively; OPT_UTC_Z writes UTC as "Z" like
+    Pydantic does, and default=str covers ObjectId.
+    """
+    return orjson.dumps(obj, default=str, option=orjson.OPT_UTC_Z)
+
+
+# Set by Response itself on replay — never stored
+_SKIP_HEADERS = frozenset({"content-length", "content-type"})
+
+
+def encode(result) -> tuple:
+    """Split an endpoint result into the (body, headers) pair that gets cached."""
+    if isinstance(result, Response):
+        headers = {k: v for k, v in result.headers.items() if k not in _SKIP_HEADERS}
+        return result.body, headers
+    return dumps(result), {}
+
+
+def decode(entry: dict) -> tuple:
+    """(body, headers) from the Redis hash fields."""
+    headers = {k[2:].decode(): v.decode() for k, v in entry.items() if k[:2] == b"h:"}
+    return entry[b"body"], headers
+
+
+def replay(body: bytes, headers: dict) -> Response:
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+async def store(key: str, body: bytes, headers: dict, ttl: int, grace: int, ver) -> bool:
+    """
+    Write an entry that is fresh for `ttl` and expires after `ttl + grace`.
+    `ver` is the products:ver value read before the result was computed; if
+    a write has bumped it since, the result may predate that write and is
+    dropped. WATCH makes the check and the write atomic.
+    Returns whether the entry was written.
+    """
+    entry = {"body": body, "stale_after": str(time.time() + ttl), "ver": ver or b""}
+    for name, value in headers.items():
+        entry[f"h:{name}"] = value
+    try:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            await pipe.watch(VERSION_KEY)
+            if await pipe.get(VERSION_KEY) != ver:
+                return False
+            pipe.multi()
+            pipe.delete(key)
+            pipe.hset(key, mapping=entry)
+            pipe.expire(key, ttl + grace)
+            await pipe.execute()
+        return True
+    except redis.RedisError:  # includes WatchError — a write landed mid-check
+        return False
+
+
+async def _refresh(key: str, func, kwargs: dict, ttl: int, grace: int, ver):
+    """Recompute a stale entry in the background; on failure the stale copy stays."""
+    try:
+        result = await func(**kwargs)
+    except Exception as e:
+        print(f"[cache] refresh of {key} failed, serving stale: {e}")
+        return
+    await store(key, *encode(result), ttl, grace, ver)
+
+
+# ── Decorator ─────────────────────────────────────────────────
+def cached(ttl: int, key_fn: Callable[..., Awaitable[str]], grace: int = 0, versioned: bool = False):
+    """
+    Cache-aside wrapper for async endpoints, with stale-while-revalidate.
+    key_fn receives the endpoint's keyword arguments and returns the Redis key.
+    With versioned=True an entry built before the latest products:ver bump
+    is a miss — for results that any write may change (lists).
+    Hits replay the stored JSON bytes — no decode/re-encode round-trip.
+    functools.wraps preserves the signature so FastAPI still sees the
+    original Query/Path parameters.
+    """
+    def decorator(func):
+        endpoint = func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(**kwargs):
+            if redis_client is None:
+                return await func(**kwargs)
+
+            local_key = (endpoint, *sorted(kwargs.items()))
+            local = _l1.get(local_key)
+            if local is not None:
+                L1_HITS.labels(endpoint).inc()
+                return replay(local[0], local[1])
+
+            gen = _l1_gen
+            try:
+                key = await key_fn(**kwargs)
+                # The version rides along in the same round-trip; store()
+                # uses it to detect writes made while the result was computed
+                pipe = redis_client.pipeline(transaction=False)
+                pipe.hgetall(key)
+                pipe.get(VERSION_KEY)
+                hit, ver = await pipe.execute()
+                if hit and versioned and hit.get(b"ver", b"") != (ver or b""):
+                    hit = {}  # built before the latest write
+                if hit and float(hit.get(b"stale_after", 0)) < time.time():
+                    CACHE_STALE.labels(endpoint).inc()
+                    # NX lock: only one replica/worker refreshes a given key
+                    if await redis_client.set(f"{key}:refresh", 1, nx=True, ex=REFRESH_LOCK_TTL):
+                        task = asyncio.create_task(_refresh(key, func, kwargs, ttl, grace, ver))
+                        _background.add(task)
+                        task.add_done_callback(_background.discard)
+            except redis.RedisError:
+                return await func(**kwargs)
+
+            if hit:
+                CACHE_HITS.labels(endpoint).inc()
+                parts = decode(hit)
+                _l1_put(local_key, gen, *parts)
+                return replay(*parts)
+
+            CACHE_MISSES.labels(endpoint).inc()
+            result = await func(**kwargs)
+            parts = encode(result)
+            if await store(key, *parts, ttl, grace, ver):
+                _l1_put(local_key, gen, *parts)
+            return result
+
+        return wrapper
+    return decorator
+
+
+async def invalidate(product_id: Optional[str] = None):
+    """
+    Bump the list version, drop the single-product key, if any, and tell
+    every worker to clear its L1.
+    Retried once: a lost invalidation leaves other replicas serving the old
+    data until it expires, so a failure is logged and counted, never silent.
+    All three commands are safe to repeat.
+    """
+    _clear_l1()
+    if redis_client is None:
+        return
+    for attempt in (1, 2):
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.incr(VERSION_KEY)
+            if product_id:
+                pipe.delete(await item_key(product_id))
+            pipe.publish(INVALIDATE_CHANNEL, product_id or "")
+            await pipe.execute()
+            return
+        except redis.RedisError as e:
+            error = e
+    INVALIDATION_FAILURES.inc()
+    print(f"[cache] Invalidation failed (product {product_id or '-'}), "
+          f"replicas may serve stale data for up to {ITEM_TTL + ITEM_GRACE}s: {error}")
+
+
+async def listen_for_invalidations():
+    """
+    Clear L1 whenever any worker publishes a write. Writes are rare, so
+    dropping the whole (small) L1 is simpler than tracking which lists
+    contain which product. While disconnected, messages can be missed:
+    L1 is cleared on every (re)subscribe and its TTL bounds staleness.
+    Polls with an explicit timeout: a blocking listen() would trip the
+    client's short socket_timeout whenever the channel is quiet.
+    """
+    while True:
+        try:
+            async with redis_client.pubsub() as pubsub:
+                await pubsub.subscribe(INVALIDATE_CHANNEL)
+                _clear_l1()
+                while True:
+                    message = await pubsub.get_message(
+                        ignore_subscribe_messages=True, timeout=HEALTH_CHECK_INTERVAL
+                    )
+                    if message is not None:
+                        _clear_l1()
+        except redis.RedisError as e:
+            print(f"[cache] Invalidation listener error, resubscribing: {e}")
+            await asyncio.sleep(1)
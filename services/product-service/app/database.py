@@ -15,6 +15,9 @@ class Settings(BaseSettings):
     MONGO_DB: str  = "products"
     PORT: int      = 8000
     JWT_SECRET: str = "super-secret-change-in-prod"
+    REDIS_HOST: str = "localhost"
+    REDIS_PORT: int = 6379
+    REDIS_PASSWORD: str = ""
 
     class Config:
         env_file = ".env"
@@ -34,10 +37,15 @@ def get_database():
 async def connect_to_mongo():
     """Called at app startup to initialise the Motor client."""
     global client
-    client = AsyncIOMotorClient(settings.MONGO_URI)
+    # tz_aware: read datetimes back as UTC-aware, matching what handlers write
+    client = AsyncIOMotorClient(settings.MONGO_URI, tz_aware=True)
     # Create text index for product search on first connection
     db = get_database()
     await db.products.create_index([("name", "text"), ("description", "text")])
+    # Keyset pagination indexes for GET /products (newest first, _id tie-break),
+    # with and without a category filter
+    await db.products.create_index([("category", 1), ("created_at", -1), ("_id", -1)])
+    await db.products.create_index([("created_at", -1), ("_id", -1)])
     print(f"[db] Connected to MongoDB: {settings.MONGO_URI}/{settings.MONGO_DB}")
 
 
@@ -7,18 +7,27 @@
 #   - Pydantic integration for request validation
 #   - Python's ecosystem makes it easy to add ML-based product recommendations later
 
+import asyncio
+import base64
 import os
+import re
 import time
 from contextlib import asynccontextmanager
 from typing import Optional, List
-from datetime import datetime
+from datetime import datetime, timezone
 
 from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.responses import JSONResponse, Response
 from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ReturnDocument
 from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
 
 from .database import connect_to_mongo, close_mongo_connection, get_database, settings
+from .cache import (
+    connect_to_redis, close_redis_connection, cached, invalidate, dumps,
+    list_key, item_key, LIST_TTL, LIST_GRACE, ITEM_TTL, ITEM_GRACE,
+)
 from .models import ProductCreate, ProductUpdate, ProductResponse
 
 # ── Lifespan (startup + shutdown) ────────────────────────────
@@ -28,8 +37,13 @@ from .models import ProductCreate, ProductUpdate, ProductResponse
 async def lifespan(app: FastAPI):
     # Startup
     await connect_to_mongo()
+    await connect_to_redis()
+    # Warm in the background so a slow warm-up never delays readiness
+    warm_task = asyncio.create_task(warm_cache())
     yield
     # Shutdown
+    warm_task.cancel()
+    await close_redis_connection()
     await close_mongo_connection()
 
 
@@ -55,13 +69,32 @@ REQUEST_LATENCY = Histogram(
     ['endpoint']
 )
 
+# Bound label children, memoised on first use. .labels() stringifies and
+# validates the values and takes the metric's lock on every call; a plain
+# dict lookup skips all of that. Route templates keep both dicts small.
+_count_children: dict = {}
+_latency_children: dict = {}
+
 @app.middleware("http")
 async def metrics_middleware(request: Request, call_next):
-    start = time.time()
+    start = time.perf_counter()
     response = await call_next(request)
-    duration = time.time() - start
-    REQUEST_COUNT.labels(request.method, request.url.path, response.status_code).inc()
-    REQUEST_LATENCY.labels(request.url.path).observe(duration)
+    duration = time.perf_counter() - start
+    # Label by route template (/products/{product_id}), not the raw path —
+    # one series per ObjectId would grow the registry without bound
+    route = request.scope.get("route")
+    endpoint = route.path if route else "unmatched"
+
+    key = (request.method, endpoint, response.status_code)
+    counter = _count_children.get(key)
+    if counter is None:
+        counter = _count_children[key] = REQUEST_COUNT.labels(*key)
+    counter.inc()
+
+    latency = _latency_children.get(endpoint)
+    if latency is None:
+        latency = _latency_children[endpoint] = REQUEST_LATENCY.labels(endpoint)
+    latency.observe(duration)
     return response
 
 # ── Health Endpoint ───────────────────────────────────────────
@@ -93,41 +126,138 @@ def serialise_product(doc: dict) -> dict:
     doc["id"] = str(doc.pop("_id"))
     return doc
 
+def utc_now() -> datetime:
+    """
+    Current time as a tz-aware UTC datetime, truncated to milliseconds —
+    the precision MongoDB stores — so a freshly written document serialises
+    identically to the same document read back later.
+    """
+    now = datetime.now(timezone.utc)
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+# fullmatch, not match + "$": "$" would also accept a trailing newline
+_is_object_id = re.compile(r"[0-9a-fA-F]{24}").fullmatch
+
+def parse_object_id(product_id: str) -> ObjectId:
+    """
+    Parse a path id into an ObjectId once, or raise 400 if malformed.
+    The precompiled regex rejects junk ids (wrong length, non-hex) without
+    going through bson's validation and exception machinery.
+    """
+    if not _is_object_id(product_id):
+        raise HTTPException(status_code=400, detail="Invalid product ID format")
+    return ObjectId(product_id)
+
+async def product_key(product_id: str) -> str:
+    """
+    Cache key for get_product. Validates first: @cached calls this before
+    the Redis lookup, so junk ids get their 400 without a round-trip.
+    Keyed on the canonical (lower-case) id — hex ids parse case-insensitively,
+    and invalidate() must hit the same key whatever case a client used.
+    lower() gives the same string as str(ObjectId) without building one:
+    the handler parses the id itself on a miss.
+    """
+    if not _is_object_id(product_id):
+        raise HTTPException(status_code=400, detail="Invalid product ID format")
+    return await item_key(product_id.lower())
+
+
+# Fields returned by the list endpoint — keeps the Mongo payload minimal
+# if documents ever grow extra (internal) fields.
+LIST_PROJECTION = {
+    "name": 1, "description": 1, "price": 1, "stock": 1, "category": 1,
+    "image_url": 1, "created_at": 1, "updated_at": 1,
+}
+
+# Newest first, _id as tie-breaker so keyset pagination is stable when two
+# products share a created_at. Backed by the compound indexes in database.py.
+LIST_SORT = [("created_at", -1), ("_id", -1)]
+
+
+def encode_cursor(doc: dict) -> str:
+    """Opaque keyset cursor pointing just past `doc` in LIST_SORT order."""
+    raw = f"{doc['created_at'].isoformat()}|{doc['_id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> dict:
+    """Turn a cursor back into a query that resumes after the last seen product."""
+    try:
+        ts, oid = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        ts, oid = datetime.fromisoformat(ts), ObjectId(oid)
+    except (ValueError, InvalidId):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return {"$or": [
+        {"created_at": {"$lt": ts}},
+        {"created_at": ts, "_id": {"$lt": oid}},
+    ]}
+
+
 # ── CRUD Endpoints ────────────────────────────────────────────
 
-@app.get("/products", response_model=List[ProductResponse], tags=["products"])
+# No response_model here: re-validating every document through Pydantic is
+# the dominant CPU cost of a 100-item page. Documents are already shaped by
+# the projection and serialised straight to JSON with orjson.
+@app.get("/products", tags=["products"], responses={200: {"model": List[ProductResponse]}})
+@cached(ttl=LIST_TTL, key_fn=list_key, grace=LIST_GRACE, versioned=True)
 async def list_products(
     category: Optional[str] = Query(None, description="Filter by category"),
     search:   Optional[str] = Query(None, description="Full-text search on name/description"),
     skip:     int           = Query(0, ge=0),
     limit:    int           = Query(20, ge=1, le=100),
+    cursor:   Optional[str] = Query(None, description="Keyset cursor from X-Next-Cursor (replaces skip)"),
 ):
-    """List products with optional category filter and full-text search."""
+    """
+    List products with optional category filter and full-text search.
+
+    Browsing is newest-first. Pass the X-Next-Cursor header of one page as
+    ?cursor= to fetch the next: the server seeks straight to it via the
+    index instead of walking `skip` documents. Search results are ranked by
+    text score and paginate with skip.
+    """
     db = get_database()
     query = {}
     if category:
         query["category"] = category
+
     if search:
         # Uses the text index created in database.py startup
         query["$text"] = {"$search": search}
+        projection = {**LIST_PROJECTION, "score": {"$meta": "textScore"}}
+        find = db.products.find(query, projection=projection) \
+            .sort([("score", {"$meta": "textScore"})]).skip(skip)
+    else:
+        if cursor:
+            query.update(decode_cursor(cursor))
+        find = db.products.find(query, projection=LIST_PROJECTION).sort(LIST_SORT)
+        if not cursor:
+            find = find.skip(skip)
 
-    cursor = db.products.find(query).skip(skip).limit(limit)
-    products = [serialise_product(doc) async for doc in cursor]
-    return products
+    # to_list drains the whole page in one await instead of one per document
+    docs = await find.limit(limit).to_list(length=limit)
+
+    headers = {}
+    if not search and len(docs) == limit:
+        headers["X-Next-Cursor"] = encode_cursor(docs[-1])
+    for doc in docs:
+        doc.pop("score", None)
+    products = [serialise_product(doc) for doc in docs]
+    return Response(content=dumps(products), media_type="application/json", headers=headers)
 
 
 @app.get("/products/{product_id}", response_model=ProductResponse, tags=["products"])
+@cached(ttl=ITEM_TTL, key_fn=product_key, grace=ITEM_GRACE)
 async def get_product(product_id: str):
     """Get a single product by its MongoDB ObjectId."""
-    if not ObjectId.is_valid(product_id):
-        raise HTTPException(status_code=400, detail="Invalid product ID format")
-
+    oid = parse_object_id(product_id)
     db = get_database()
-    doc = await db.products.find_one({"_id": ObjectId(product_id)})
+    doc = await db.products.find_one({"_id": oid})
     if not doc:
         raise HTTPException(status_code=404, detail="Product not found")
 
-    return serialise_product(doc)
+    # Shape the document through the response model here, not only via
+    # response_model: cache hits replay this dict's bytes and bypass it
+    return ProductResponse(**serialise_product(doc)).model_dump(mode="json")
 
 
 @app.post("/products", response_model=ProductResponse, status_code=201, tags=["products"])
@@ -135,47 +265,70 @@ async def create_product(payload: ProductCreate):
     """Create a new product. In production this route is gated behind key-auth Kong plugin."""
     db = get_database()
     doc = payload.model_dump()
-    doc["created_at"] = datetime.utcnow()
+    doc["created_at"] = utc_now()
     doc["updated_at"] = None
 
-    result = await db.products.insert_one(doc)
-    created = await db.products.find_one({"_id": result.inserted_id})
-    return serialise_product(created)
+    # insert_one sets doc["_id"] in place — no need to read the document back
+    await db.products.insert_one(doc)
+    await invalidate()
+    return serialise_product(doc)
 
 
 @app.patch("/products/{product_id}", response_model=ProductResponse, tags=["products"])
 async def update_product(product_id: str, payload: ProductUpdate):
     """Partial update — only provided fields are changed (PATCH semantics)."""
-    if not ObjectId.is_valid(product_id):
-        raise HTTPException(status_code=400, detail="Invalid product ID format")
-
+    oid = parse_object_id(product_id)
     db = get_database()
     # model_dump(exclude_none=True) skips fields the client didn't provide
     updates = payload.model_dump(exclude_none=True)
     if not updates:
         raise HTTPException(status_code=400, detail="No fields provided for update")
 
-    updates["updated_at"] = datetime.utcnow()
-    result = await db.products.update_one(
-        {"_id": ObjectId(product_id)},
-        {"$set": updates}
+    updates["updated_at"] = utc_now()
+    # One round-trip: apply the update and return the post-update document
+    updated = await db.products.find_one_and_update(
+        {"_id": oid},
+        {"$set": updates},
+        return_document=ReturnDocument.AFTER,
     )
 
-    if result.matched_count == 0:
+    if updated is None:
         raise HTTPException(status_code=404, detail="Product not found")
 
-    updated = await db.products.find_one({"_id": ObjectId(product_id)})
+    await invalidate(str(oid))
     return serialise_product(updated)
 
 
 @app.delete("/products/{product_id}", status_code=204, tags=["products"])
 async def delete_product(product_id: str):
     """Delete a product by ID."""
-    if not ObjectId.is_valid(product_id):
-        raise HTTPException(status_code=400, detail="Invalid product ID format")
-
+    oid = parse_object_id(product_id)
     db = get_database()
-    result = await db.products.delete_one({"_id": ObjectId(product_id)})
+    result = await db.products.delete_one({"_id": oid})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Product not found")
+    await invalidate(str(oid))
     # 204 No Content — no body returned
+
+
+# ── Cache warm-up ─────────────────────────────────────────────
+WARM_TOP_CATEGORIES = 10
+
+async def warm_cache():
+    """
+    Prefetch the first page of the unfiltered list and of the most populated
+    categories, so the first visitors after a deploy don't all hit MongoDB.
+    """
+    try:
+        db = get_database()
+        top = await db.products.aggregate([
+            {"$group": {"_id": "$category", "count": {"$sum": 1}}},
+            {"$sort": {"count": -1}},
+            {"$limit": WARM_TOP_CATEGORIES},
+        ]).to_list(length=WARM_TOP_CATEGORIES)
+        for category in [None] + [c["_id"] for c in top]:
+            # Calls through the @cached wrapper, which stores the page on miss
+            await list_products(category=category, search=None, skip=0, limit=20, cursor=None)
+        print(f"[cache] Warmed {len(top) + 1} product list pages")
+    except Exception as e:
+        print(f"[cache] Warm-up skipped: {e}")